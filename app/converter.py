@@ -5,13 +5,193 @@ Utilities to convert natural language descriptions into a lightweight BPMN diagr
 from __future__ import annotations
 
 import re
+from functools import lru_cache
+from io import StringIO
 from typing import Dict, List, Optional, Tuple
-from xml.sax.saxutils import escape
 
+try:
+    # Optional speedup: a single-pass automaton for the role scan.
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Patterns are compiled once at import time so each conversion request only
+# pays for the scan itself, not for re-parsing the pattern strings.
+_RE_SUMMARY_CUT = re.compile(
+    r"در\s+کل\s*،?\s*فرایند\s+شامل.*", re.IGNORECASE | re.DOTALL)
+_RE_HEADLINE = re.compile(
+    r"\b(includes|consists of|comprises|شامل|متشکل از)\b", re.IGNORECASE)
+# All connectors fused into one alternation: a single scan replaces the old
+# 16-pass substitution loop.
+_RE_CONNECTORS = re.compile(
+    r"\b(?:then|and then|afterwards|after that|finally|at last|ultimately"
+    r"|subsequently|next|and)\b"
+    r"|سپس|بعداً|بعد از آن|در نهایت|و سپس|و در نهایت",
+    re.IGNORECASE,
+)
+_RE_PRIMARY_SPLIT = re.compile(r"[.\n\r؛]")
+_RE_COMMA_SPLIT = re.compile(
+    r",[ ]*(?=(?:and|then|after|finally|در نهایت|سپس|و)\b)", re.IGNORECASE
+)
+_RE_LEADING_CONNECTOR = re.compile(
+    r"^(?:and|then|after|finally|next|ultimately|در نهایت|سپس|بعداً|بعد از آن|و سپس|و)\b[\s،]*",
+    re.IGNORECASE,
+)
+_RE_BRANCH_MAIN = re.compile(
+    r"اگر\s+(?P<cond>.+?)\s*(?:باشد|است)?\s*,\s*(?P<yes>.+?)\s*(?:\.|\s+)?\s*(?:اما|ولی)\s+اگر\s+(?P<no_clause>[^.]+?)(?:\.|\s*$)",
+    re.IGNORECASE,
+)
+_RE_BRANCH_ALT = re.compile(
+    r"در\s+صورتی\s+که\s+(?P<cond>.+?)\s*(?:باشد|است)?\s*[,،]\s*(?P<yes>.+?)\s*(?:[.;؛]|$)\s*(?:اما|ولی)\s+در\s+صورتی\s+که\s+(?P<no_cond>.+?)\s*(?:باشد|است)?\s*[,،]\s*(?P<no>.+?)(?:[.;؛]|\s*$)",
+    re.IGNORECASE,
+)
+_RE_BRANCH_PAR = re.compile(
+    r"اگر\s+(?P<cond>[^:]+):\s*(?P<yes>.+?)\s*(?:اما|ولی)?\s*اگر\s+(?P<no_cond>[^:]+):\s*(?P<no>.+)",
+    re.IGNORECASE | re.DOTALL,
+)
+_RE_SENTENCE_END = re.compile(r"[.;]")
+_RE_BASHAD = re.compile(r"\bباشد\b")
+# Multi-branch detection scans for 'اگر' positions and slices between them
+# instead of running a lookahead-heavy findall over the whole text.
+_RE_AGAR = re.compile(r"اگر\b")
+_RE_CLAUSE_SEP = re.compile(r"[:،,]")
+_RE_CLAUSE_VERB = re.compile(r"\s(?:بود|باشد|است)\s")
+_RE_TRAILING_PUNCT = re.compile(r"[.؛]+$")
+
+# Role keywords ordered longest-first so the alternation prefers the most
+# specific role; one compiled scan replaces per-role substring searches.
+_ROLES = [
+    "کارشناس ارشد پشتیبانی ستاد",
+    "کارشناس ارشد",
+    "کارشناس بررسی شکایت",
+    "کارشناس پشتیبانی",
+    "کارشناس شکایت ستاد",
+    "کارشناس ستاد",
+    "کارشناس اولیه",
+    "کارشناس",
+    "کارمند",
+    "کاربر",
+]
+_RE_ROLE = re.compile("|".join(map(re.escape, _ROLES)))
+_RE_PREFACE = re.compile(
+    r"فرایند.+?(?:به شرح (?:ذیل|زیر) (?:میباشد|است)?:?)")
+
+# Maximum characters per wrapped label line.
+_LABEL_WIDTH = 24
+
+if ahocorasick is not None:
+    _ROLE_AUTOMATON = ahocorasick.Automaton()
+    for _role in _ROLES:
+        _ROLE_AUTOMATON.add_word(_role, _role)
+    _ROLE_AUTOMATON.make_automaton()
+else:
+    _ROLE_AUTOMATON = None
+
+
+def _find_role(text: str) -> Optional[Tuple[str, int, int]]:
+    """
+    Locate the role keyword to extract from `text`.
+    Returns (role, start, end) of the leftmost (longest on ties) match, or
+    None. Uses the Aho-Corasick automaton when pyahocorasick is installed,
+    otherwise the compiled alternation.
+    """
+    if _ROLE_AUTOMATON is not None:
+        best_role = ""
+        best_start = -1
+        for end, role in _ROLE_AUTOMATON.iter(text):
+            start = end - len(role) + 1
+            if (best_start < 0 or start < best_start
+                    or (start == best_start and len(role) > len(best_role))):
+                best_role = role
+                best_start = start
+        if best_start < 0:
+            return None
+        return best_role, best_start, best_start + len(best_role)
+    m = _RE_ROLE.search(text)
+    if m:
+        return m.group(0), m.start(), m.end()
+    return None
+
+
+# Constant XML segments for the streaming writer: the document is emitted as
+# literal chunks plus interpolated values into one contiguous buffer, instead
+# of re-parsing f-string templates per node.
+_XML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<bpmn:definitions xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"\n'
+    '                  xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL"\n'
+    '                  xmlns:bpmndi="http://www.omg.org/spec/BPMN/20100524/DI"\n'
+    '                  xmlns:dc="http://www.omg.org/spec/DD/20100524/DC"\n'
+    '                  xmlns:di="http://www.omg.org/spec/DD/20100524/DI"\n'
+    '                  id="Definitions_1"\n'
+    '                  targetNamespace="http://example.com/bpmn">\n'
+    '  <bpmn:process id="Process_1" isExecutable="false">'
+)
+_XML_PROCESS_CLOSE = (
+    '\n  </bpmn:process>\n'
+    '  <bpmndi:BPMNDiagram id="BPMNDiagram_1">\n'
+    '    <bpmndi:BPMNPlane id="BPMNPlane_1" bpmnElement="Process_1">\n'
+    '      '
+)
+_XML_FOOTER = (
+    '\n    </bpmndi:BPMNPlane>\n'
+    '  </bpmndi:BPMNDiagram>\n'
+    '</bpmn:definitions>\n'
+)
+
+
+def _ws(text: str) -> str:
+    """
+    Collapse whitespace runs to single spaces and trim the ends.
+    str.split with no separator already splits on any whitespace run, so
+    this stays entirely in the C string layer.
+    """
+    return " ".join(text.split())
+
+
+# DI element templates: %-formatting reuses one pre-parsed template per
+# element instead of re-parsing an f-string for every shape and edge.
+_SHAPE_FMT = (
+    '<bpmndi:BPMNShape id="%s_di" bpmnElement="%s">\n'
+    '        <dc:Bounds x="%.0f" y="%.0f" width="%d" height="%d"/>\n'
+    '      </bpmndi:BPMNShape>'
+)
+_EDGE_FMT = (
+    '<bpmndi:BPMNEdge id="%s_di" bpmnElement="%s">\n'
+    '        <di:waypoint x="%.0f" y="%.0f"/>\n'
+    '        <di:waypoint x="%.0f" y="%.0f"/>\n'
+    '      </bpmndi:BPMNEdge>'
+)
+
+
+# Escape table for str.translate: one C-level pass over the label instead of
+# saxutils.escape's chained str.replace calls. Labels land in attribute
+# values, so double quotes are escaped too.
+_XML_ESC = {
+    ord("&"): "&amp;",
+    ord("<"): "&lt;",
+    ord(">"): "&gt;",
+    ord('"'): "&quot;",
+}
+
+
+@lru_cache(maxsize=2048)
+def escape(text: str) -> str:
+    """
+    XML-escape `text`, caching results since the same task labels recur
+    across (and within) conversions.
+    """
+    return text.translate(_XML_ESC)
 
+
+@lru_cache(maxsize=256)
 def convert_text_to_bpmn(user_text: str) -> str:
     """
     Convert a plain language description into a BPMN XML diagram string.
+
+    The conversion is deterministic in `user_text`, so results are cached:
+    reposting the same description returns the prior XML without re-running
+    the extraction and serialization pipeline.
     """
     steps = _extract_steps(user_text)
     if not steps:
@@ -19,7 +199,6 @@ def convert_text_to_bpmn(user_text: str) -> str:
             "امکان ساخت نمودار وجود ندارد. لطفاً توضیح را با جملات یا مراحل مشخص وارد کنید."
         )
 
-    process_id = "Process_1"
     start_id = "StartEvent_1"
     end_id = "EndEvent_1"
 
@@ -29,8 +208,12 @@ def convert_text_to_bpmn(user_text: str) -> str:
 
     if branch or multi_branch:
         # Build a diagram with an exclusive gateway split and join
-        process_elements: List[str] = [
-            f'<bpmn:startEvent id="{start_id}" name="شروع"/>']
+        buf = StringIO()
+        w = buf.write
+        w(_XML_HEADER)
+        w('\n      <bpmn:startEvent id="')
+        w(start_id)
+        w('" name="شروع"/>')
 
         node_types: Dict[str, str] = {
             start_id: "start",
@@ -42,160 +225,171 @@ def convert_text_to_bpmn(user_text: str) -> str:
         nodes_order: List[str] = [start_id]
         edges: List[Tuple[str, str, str]] = []
 
-        # Steps before the decision (use text before first 'اگر')
-        pre_text = user_text.split("اگر", 1)[0]
+        # Steps before the decision (text before the first 'اگر', whose
+        # offset the detector already found)
+        pre_text = user_text[:(branch or multi_branch)["_pre_end"]]
         pre_steps = _extract_steps(pre_text)
 
         pre_task_ids: List[str] = []
         for index, step in enumerate(pre_steps):
-            label = _format_label_with_role(step)
+            label, label_lines = _label_for_task(step)
             node_id = f"Activity_{index+1}"
             pre_task_ids.append(node_id)
             nodes_order.append(node_id)
             node_types[node_id] = "task"
             node_columns[node_id] = index + 1
             node_rows[node_id] = 0
-            label_lines_by_id[node_id] = label.count("\n") + 1
-            process_elements.append(
-                f'<bpmn:task id="{node_id}" name="{escape(label)}"/>')
+            label_lines_by_id[node_id] = label_lines
+            w('\n      <bpmn:task id="')
+            w(node_id)
+            w('" name="')
+            w(escape(label))
+            w('"/>')
 
         # Decision gateway
         split_id = "Gateway_Split_1"
         question = (branch or {}).get("question") or "تصمیم‌گیری"
-        process_elements.append(
-            f'<bpmn:exclusiveGateway id="{split_id}" name="{escape(question)}"/>'
-        )
+        w('\n      <bpmn:exclusiveGateway id="')
+        w(split_id)
+        w('" name="')
+        w(escape(question))
+        w('"/>')
         node_types[split_id] = "gateway"
         node_columns[split_id] = (node_columns.get(
             pre_task_ids[-1], 0) + 1) if pre_task_ids else 1
         node_rows[split_id] = 0
         nodes_order.append(split_id)
 
-        # Build branches
-        branch_start_ids: List[str] = []
-        branch_end_ids: List[str] = []
-        branch_internal_edges: List[Tuple[str, str]] = []
-        branch_levels: Dict[str, int] = {}
-        branch_rows: Dict[str, int] = {}
+        # Flows are recorded as nodes are created; the sequenceFlow XML is
+        # still emitted in one block after the nodes.
+        flow_index = 1
+
+        def add_flow(src: str, dst: str):
+            nonlocal flow_index
+            fid = f"Flow_{flow_index}"
+            flow_index += 1
+            edges.append((fid, src, dst))
+            return fid
+
+        add_flow(start_id, pre_task_ids[0] if pre_task_ids else split_id)
+        for a, b in zip(pre_task_ids, pre_task_ids[1:]):
+            add_flow(a, b)
+        if pre_task_ids:
+            add_flow(pre_task_ids[-1], split_id)
+
+        # Build branches, wiring each node to the split as it is created and
+        # queueing its edge into the join for after the join gateway exists.
+        join_id = "Gateway_Join_1"
+        pending_join_edges: List[Tuple[str, str]] = []
+        max_branch_level = node_columns[split_id]
         if branch:
             # yes/no branches
-            yes_label = _format_label_with_role(branch["yes_action"])
+            yes_label, yes_lines = _label_for_task(
+                branch["yes_action"])
             yes_id = "Activity_Yes_1"
-            process_elements.append(
-                f'<bpmn:task id="{yes_id}" name="{escape(yes_label)}"/>')
+            w('\n      <bpmn:task id="')
+            w(yes_id)
+            w('" name="')
+            w(escape(yes_label))
+            w('"/>')
             node_types[yes_id] = "task"
             node_columns[yes_id] = node_columns[split_id] + 1
             node_rows[yes_id] = 0
             nodes_order.append(yes_id)
-            label_lines_by_id[yes_id] = yes_label.count("\n") + 1
-            branch_start_ids.append(yes_id)
-            branch_end_ids.append(yes_id)
-            branch_levels[yes_id] = node_columns[yes_id]
-            branch_rows[yes_id] = node_rows[yes_id]
+            label_lines_by_id[yes_id] = yes_lines
+            add_flow(split_id, yes_id)
+            pending_join_edges.append((yes_id, join_id))
+            max_branch_level = max(max_branch_level, node_columns[yes_id])
 
-            no_label = _format_label_with_role(branch["no_action"])
+            no_label, no_lines = _label_for_task(branch["no_action"])
             no_id = "Activity_No_1"
-            process_elements.append(
-                f'<bpmn:task id="{no_id}" name="{escape(no_label)}"/>')
+            w('\n      <bpmn:task id="')
+            w(no_id)
+            w('" name="')
+            w(escape(no_label))
+            w('"/>')
             node_types[no_id] = "task"
             node_columns[no_id] = node_columns[split_id] + 1
             node_rows[no_id] = 1
             nodes_order.append(no_id)
-            label_lines_by_id[no_id] = no_label.count("\n") + 1
-            branch_start_ids.append(no_id)
-            branch_end_ids.append(no_id)
-            branch_levels[no_id] = node_columns[no_id]
-            branch_rows[no_id] = node_rows[no_id]
+            label_lines_by_id[no_id] = no_lines
+            add_flow(split_id, no_id)
+            pending_join_edges.append((no_id, join_id))
+            max_branch_level = max(max_branch_level, node_columns[no_id])
 
             # Optional follow-up on the "no" path
             if branch.get("after_no_action"):
-                follow_label = _format_label_with_role(
+                follow_label, follow_lines = _label_for_task(
                     branch["after_no_action"])
                 follow_id = "Activity_No_2"
-                process_elements.append(
-                    f'<bpmn:task id="{follow_id}" name="{escape(follow_label)}"/>')
+                w('\n      <bpmn:task id="')
+                w(follow_id)
+                w('" name="')
+                w(escape(follow_label))
+                w('"/>')
                 node_types[follow_id] = "task"
                 node_columns[follow_id] = node_columns[no_id] + 1
                 node_rows[follow_id] = 1
                 nodes_order.append(follow_id)
-                label_lines_by_id[follow_id] = follow_label.count("\n") + 1
-                # Update end node for 'no' branch (do not change its start)
-                branch_end_ids[-1] = follow_id
-                branch_levels[follow_id] = node_columns[follow_id]
-                branch_rows[follow_id] = node_rows[follow_id]
-                # Connect no -> follow
-                branch_internal_edges.append((no_id, follow_id))
+                label_lines_by_id[follow_id] = follow_lines
+                # Connect no -> follow and let the follow-up end the branch
+                # (its start at the split is unchanged)
+                add_flow(no_id, follow_id)
+                pending_join_edges[-1] = (follow_id, join_id)
+                max_branch_level = max(
+                    max_branch_level, node_columns[follow_id])
         else:
             # Multi-branch detected
             for idx, action in enumerate(multi_branch["branches"]):
-                label = _format_label_with_role(action)
+                label, label_lines = _label_for_task(action)
                 node_id = f"Activity_B_{idx+1}"
-                process_elements.append(
-                    f'<bpmn:task id="{node_id}" name="{escape(label)}"/>')
+                w('\n      <bpmn:task id="')
+                w(node_id)
+                w('" name="')
+                w(escape(label))
+                w('"/>')
                 node_types[node_id] = "task"
                 node_columns[node_id] = node_columns[split_id] + 1
                 node_rows[node_id] = idx
                 nodes_order.append(node_id)
-                label_lines_by_id[node_id] = label.count("\n") + 1
-                branch_start_ids.append(node_id)
-                branch_end_ids.append(node_id)
-                branch_levels[node_id] = node_columns[node_id]
-                branch_rows[node_id] = node_rows[node_id]
-
-        # Join gateway
-        join_id = "Gateway_Join_1"
-        process_elements.append(
-            f'<bpmn:exclusiveGateway id="{join_id}" name=""/>')
+                label_lines_by_id[node_id] = label_lines
+                add_flow(split_id, node_id)
+                pending_join_edges.append((node_id, join_id))
+                max_branch_level = max(
+                    max_branch_level, node_columns[node_id])
+
+        # Join gateway, placed after the deepest branch level
+        w('\n      <bpmn:exclusiveGateway id="')
+        w(join_id)
+        w('" name=""/>')
         node_types[join_id] = "gateway"
-        # place join below the deepest branch level
-        max_level = max(branch_levels.values()) if branch_end_ids else node_columns.get(
-            split_id, 0)
-        node_columns[join_id] = max_level + 1
+        node_columns[join_id] = max_branch_level + 1
         node_rows[join_id] = 0
         nodes_order.append(join_id)
 
+        # connect each branch end to join
+        for src, dst in pending_join_edges:
+            add_flow(src, dst)
+
         # End
-        process_elements.append(f'<bpmn:endEvent id="{end_id}" name="پایان"/>')
+        w('\n      <bpmn:endEvent id="')
+        w(end_id)
+        w('" name="پایان"/>')
         node_types[end_id] = "end"
         node_columns[end_id] = node_columns[join_id] + 1
         node_rows[end_id] = 0
         nodes_order.append(end_id)
-
-        # Flows
-        flow_index = 1
-
-        def add_flow(src: str, dst: str):
-            nonlocal flow_index
-            fid = f"Flow_{flow_index}"
-            flow_index += 1
-            edges.append((fid, src, dst))
-            return fid
-
-        add_flow(start_id, pre_task_ids[0] if pre_task_ids else split_id)
-        for a, b in zip(pre_task_ids, pre_task_ids[1:]):
-            add_flow(a, b)
-        if pre_task_ids:
-            add_flow(pre_task_ids[-1], split_id)
-
-        # connect split to branch starts
-        for bid in branch_start_ids:
-            add_flow(split_id, bid)
-        # connect internal edges within branches (e.g., no -> follow)
-        for a, b in branch_internal_edges:
-            add_flow(a, b)
-        # connect each branch end to join
-        for bid in branch_end_ids:
-            add_flow(bid, join_id)
-
         add_flow(join_id, end_id)
 
         # Process XML: sequenceFlows
         for fid, src, dst in edges:
-            process_elements.append(
-                f'<bpmn:sequenceFlow id="{fid}" sourceRef="{src}" targetRef="{dst}"/>'
-            )
-
-        process_xml = "\n      ".join(process_elements)
+            w('\n      <bpmn:sequenceFlow id="')
+            w(fid)
+            w('" sourceRef="')
+            w(src)
+            w('" targetRef="')
+            w(dst)
+            w('"/>')
 
         shapes_xml, edges_xml = _build_diagrams_complex(
             nodes_order,
@@ -206,79 +400,59 @@ def convert_text_to_bpmn(user_text: str) -> str:
             node_types,
         )
 
-        return f"""<?xml version="1.0" encoding="UTF-8"?>
-<bpmn:definitions xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-                  xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL"
-                  xmlns:bpmndi="http://www.omg.org/spec/BPMN/20100524/DI"
-                  xmlns:dc="http://www.omg.org/spec/DD/20100524/DC"
-                  xmlns:di="http://www.omg.org/spec/DD/20100524/DI"
-                  id="Definitions_1"
-                  targetNamespace="http://example.com/bpmn">
-  <bpmn:process id="{process_id}" isExecutable="false">
-      {process_xml}
-  </bpmn:process>
-  <bpmndi:BPMNDiagram id="BPMNDiagram_1">
-    <bpmndi:BPMNPlane id="BPMNPlane_1" bpmnElement="{process_id}">
-      {shapes_xml}
-      {edges_xml}
-    </bpmndi:BPMNPlane>
-  </bpmndi:BPMNDiagram>
-</bpmn:definitions>
-"""
+        w(_XML_PROCESS_CLOSE)
+        w(shapes_xml)
+        w('\n      ')
+        w(edges_xml)
+        w(_XML_FOOTER)
+        return buf.getvalue()
     else:
         # Fallback: simple linear diagram
-        wrapped_steps = [_format_label_with_role(step) for step in steps]
+        wrapped_steps = [_label_for_task(step) for step in steps]
         task_ids = [
             f"Activity_{index+1}" for index in range(len(wrapped_steps))]
         flow_ids = [f"Flow_{index+1}" for index in range(len(steps) + 1)]
 
-        process_elements = [
-            f'<bpmn:startEvent id="{start_id}" name="شروع"/>',
-        ]
+        buf = StringIO()
+        w = buf.write
+        w(_XML_HEADER)
+        w('\n      <bpmn:startEvent id="')
+        w(start_id)
+        w('" name="شروع"/>')
 
         label_lines_by_id: Dict[str, int] = {}
-        for task_id, label in zip(task_ids, wrapped_steps):
-            process_elements.append(
-                f'<bpmn:task id="{task_id}" name="{escape(label)}"/>'
-            )
-            label_lines_by_id[task_id] = label.count("\n") + 1
+        for task_id, (label, label_lines) in zip(task_ids, wrapped_steps):
+            w('\n      <bpmn:task id="')
+            w(task_id)
+            w('" name="')
+            w(escape(label))
+            w('"/>')
+            label_lines_by_id[task_id] = label_lines
+
+        w('\n      <bpmn:endEvent id="')
+        w(end_id)
+        w('" name="پایان"/>')
 
-        process_elements.append(f'<bpmn:endEvent id="{end_id}" name="پایان"/>')
-
-        sequence_flows = []
         all_nodes = [start_id] + task_ids + [end_id]
 
         for index, flow_id in enumerate(flow_ids):
-            source = all_nodes[index]
-            target = all_nodes[index + 1]
-            sequence_flows.append(
-                f'<bpmn:sequenceFlow id="{flow_id}" sourceRef="{source}" targetRef="{target}"/>'
-            )
-
-        process_xml = "\n      ".join(process_elements + sequence_flows)
+            w('\n      <bpmn:sequenceFlow id="')
+            w(flow_id)
+            w('" sourceRef="')
+            w(all_nodes[index])
+            w('" targetRef="')
+            w(all_nodes[index + 1])
+            w('"/>')
 
         shapes_xml, edges_xml = _build_diagrams(
             all_nodes, flow_ids, label_lines_by_id)
 
-        return f"""<?xml version="1.0" encoding="UTF-8"?>
-<bpmn:definitions xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
-                  xmlns:bpmn="http://www.omg.org/spec/BPMN/20100524/MODEL"
-                  xmlns:bpmndi="http://www.omg.org/spec/BPMN/20100524/DI"
-                  xmlns:dc="http://www.omg.org/spec/DD/20100524/DC"
-                  xmlns:di="http://www.omg.org/spec/DD/20100524/DI"
-                  id="Definitions_1"
-                  targetNamespace="http://example.com/bpmn">
-  <bpmn:process id="{process_id}" isExecutable="false">
-      {process_xml}
-  </bpmn:process>
-  <bpmndi:BPMNDiagram id="BPMNDiagram_1">
-    <bpmndi:BPMNPlane id="BPMNPlane_1" bpmnElement="{process_id}">
-      {shapes_xml}
-      {edges_xml}
-    </bpmndi:BPMNPlane>
-  </bpmndi:BPMNDiagram>
-</bpmn:definitions>
-"""
+        w(_XML_PROCESS_CLOSE)
+        w(shapes_xml)
+        w('\n      ')
+        w(edges_xml)
+        w(_XML_FOOTER)
+        return buf.getvalue()
 
 
 def _extract_steps(user_text: str) -> List[str]:
@@ -286,83 +460,44 @@ def _extract_steps(user_text: str) -> List[str]:
     Extract candidate steps from user text using simple heuristics.
     """
     # Drop trailing role summary sections like "در کل، فرایند شامل ..."
-    summary_cut = re.split(r"در\s+کل\s*،?\s*فرایند\s+شامل.*", user_text, flags=re.IGNORECASE | re.DOTALL)[0]
+    summary_cut = _RE_SUMMARY_CUT.split(user_text)[0]
 
-    cleaned = re.sub(r"\s+", " ", summary_cut.strip())
+    cleaned = _ws(summary_cut)
     if not cleaned:
         return []
 
-    connectors = [
-        r"\bthen\b",
-        r"\band then\b",
-        r"\bafterwards\b",
-        r"\bafter that\b",
-        r"\bfinally\b",
-        r"\bat last\b",
-        r"\bultimately\b",
-        r"\bsubsequently\b",
-        r"\bnext\b",
-        r"\band\b",
-        r"سپس",
-        r"بعداً",
-        r"بعد از آن",
-        r"در نهایت",
-        r"و سپس",
-        r"و در نهایت",
-    ]
-
-    headline_match = re.search(
-        r"\b(includes|consists of|comprises|شامل|متشکل از)\b", cleaned, re.IGNORECASE
-    )
+    headline_match = _RE_HEADLINE.search(cleaned)
     if headline_match:
         cleaned = cleaned[headline_match.end():].strip(" :،,")
 
-    normalized = cleaned
-    for connector in connectors:
-        normalized = re.sub(
-            connector,
-            ".",
-            normalized,
-            flags=re.IGNORECASE,
-        )
+    normalized = _RE_CONNECTORS.sub(".", cleaned)
 
-    primary_fragments = re.split(r"[.\n\r؛]", normalized)
+    primary_fragments = _RE_PRIMARY_SPLIT.split(normalized)
     steps: List[str] = []
 
-    comma_split_pattern = re.compile(
-        r",[ ]*(?=(?:and|then|after|finally|در نهایت|سپس|و)\b)", re.IGNORECASE
-    )
-
     for fragment in primary_fragments:
-        fragment = fragment.strip(" -:،,")
-        if not fragment:
-            continue
-
-        sub_fragments = comma_split_pattern.split(fragment)
-        for sub in sub_fragments:
+        for sub in _RE_COMMA_SPLIT.split(fragment):
             sub = sub.strip(" -:،,")
             if sub:
-                sub = re.sub(
-                    r"^(?:and|then|after|finally|next|ultimately|در نهایت|سپس|بعداً|بعد از آن|و|و سپس)\b[\s،]*",
-                    "",
-                    sub,
-                    flags=re.IGNORECASE,
-                )
+                sub = _RE_LEADING_CONNECTOR.sub("", sub)
                 if sub:
                     steps.append(sub)
 
     return steps
 
 
-def _detect_branch(user_text: str) -> Optional[Dict[str, str]]:
+def _detect_branch(user_text: str) -> Optional[Dict[str, object]]:
     """
     Detect a simple Persian branching structure like:
     '... اگر <condition> باشد، <yes>. اما اگر <alt> <no>. <after_no>'
-    Returns a dict with question, yes_action, no_action, and optional after_no_action.
+    Returns a dict with question, yes_action, no_action, optional
+    after_no_action, and '_pre_end' — the offset in `user_text` where the
+    pre-decision text ends, so the caller need not rescan for 'اگر'.
     """
-    text = re.sub(r"\s+", " ", user_text.strip())
-    if "اگر" not in text:
+    agar_at = user_text.find("اگر")
+    if agar_at == -1:
         return None
+    text = _ws(user_text)
 
     # Normalize punctuation to make regex predictable
     norm = (
@@ -372,31 +507,19 @@ def _detect_branch(user_text: str) -> Optional[Dict[str, str]]:
     )
 
     # Capture until the next period after 'اما اگر' to avoid trailing fragments
-    m = re.search(
-        r"اگر\s+(?P<cond>.+?)\s*(?:باشد|است)?\s*,\s*(?P<yes>.+?)\s*(?:\.|\s+)?\s*(?:اما|ولی)\s+اگر\s+(?P<no_clause>[^.]+?)(?:\.|\s*$)",
-        norm,
-        flags=re.IGNORECASE,
-    )
+    m = _RE_BRANCH_MAIN.search(norm)
     if not m:
         # Persian form without 'اگر': 'در صورتی که <cond> (باشد|است)، <yes> ؛ اما در صورتی که <cond2> (باشد|است)، <no>.'
-        m_alt = re.search(
-            r"در\s+صورتی\s+که\s+(?P<cond>.+?)\s*(?:باشد|است)?\s*[,،]\s*(?P<yes>.+?)\s*(?:[.;؛]|$)\s*(?:اما|ولی)\s+در\s+صورتی\s+که\s+(?P<no_cond>.+?)\s*(?:باشد|است)?\s*[,،]\s*(?P<no>.+?)(?:[.;؛]|\s*$)",
-            norm,
-            flags=re.IGNORECASE,
-        )
+        m_alt = _RE_BRANCH_ALT.search(norm)
         if not m_alt:
             # Paragraph style with colon after condition:
             # "اگر <cond> : <yes> ...  اگر <cond2> : <no> ..."
-            m_par = re.search(
-                r"اگر\s+(?P<cond>[^:]+):\s*(?P<yes>.+?)\s*(?:اما|ولی)?\s*اگر\s+(?P<no_cond>[^:]+):\s*(?P<no>.+)",
-                user_text,
-                flags=re.IGNORECASE | re.DOTALL,
-            )
+            m_par = _RE_BRANCH_PAR.search(user_text)
             if not m_par:
                 return None
-            condition = re.sub(r"\s+", " ", m_par.group("cond")).strip()
-            yes_action = re.sub(r"\s+", " ", m_par.group("yes")).strip()
-            no_action = re.sub(r"\s+", " ", m_par.group("no")).strip()
+            condition = _ws(m_par.group("cond"))
+            yes_action = _ws(m_par.group("yes"))
+            no_action = _ws(m_par.group("no"))
             remainder = ""
             after_no_action = ""
         else:
@@ -407,8 +530,8 @@ def _detect_branch(user_text: str) -> Optional[Dict[str, str]]:
             remainder = norm[m_alt.end():].strip()
             after_no_action = ""
             if remainder:
-                after_no_action = re.split(
-                    r"[.;]", remainder, maxsplit=1)[0].strip()
+                after_no_action = _RE_SENTENCE_END.split(
+                    remainder, maxsplit=1)[0].strip()
     else:
         condition = m.group("cond").strip()
         yes_action = m.group("yes").strip()
@@ -416,15 +539,16 @@ def _detect_branch(user_text: str) -> Optional[Dict[str, str]]:
         remainder = norm[m.end():].strip()
         after_no_action = ""
         if remainder:
-            after_no_action = re.split(
-                r"[.;]", remainder, maxsplit=1)[0].strip()
+            after_no_action = _RE_SENTENCE_END.split(
+                remainder, maxsplit=1)[0].strip()
 
     question = _normalize_condition(condition)
 
-    result: Dict[str, str] = {
+    result = {
         "question": question,
         "yes_action": yes_action,
         "no_action": no_action,
+        "_pre_end": agar_at,
     }
 
     # Heuristic: prefix role 'کارشناس' if context implies it
@@ -446,104 +570,98 @@ def _detect_branch(user_text: str) -> Optional[Dict[str, str]]:
 def _normalize_condition(text: str) -> str:
     text = text.strip()
     # For Persian: turn 'قابل پاسخ گویی' into 'قابل پاسخ‌گویی؟'
-    text = re.sub(r"\s+", " ", text)
+    text = _ws(text)
     # Normalize 'باشد' → 'است'
-    text = re.sub(r"\bباشد\b", "است", text)
+    text = _RE_BASHAD.sub("است", text)
     if not text.endswith("؟"):
         text = f"{text}؟"
     return text
 
 
-def _detect_multi_branch(user_text: str) -> Optional[Dict[str, List[str]]]:
+def _detect_multi_branch(user_text: str) -> Optional[Dict[str, object]]:
     """
     Detect multiple simple 'اگر ... بود/باشد ...' branches in a row.
-    Returns dict with 'question' and 'branches' (list of actions) if >=2 found.
+    Returns dict with 'question', 'branches' (list of actions) if >=2 found,
+    and '_pre_end' — the offset of the first 'اگر' in `user_text`.
     """
-    text = re.sub(r"\s+", " ", user_text)
-    # Find all 'اگر <cond> (بود|باشد|است)? <action>' occurrences
-    pattern = re.compile(
-        r"اگر\s+(.+?)(?:\s+(?:بود|باشد|است))?\s*[:،,]?\s*(.+?)(?=(?:\s+(?:و\s+)?اگر\b)|$)",
-        re.IGNORECASE,
-    )
-    matches = pattern.findall(text)
-    if len(matches) < 2:
+    agar_at = user_text.find("اگر")
+    if agar_at == -1:
         return None
-    actions: List[str] = []
-    for (_cond, action) in matches:
-        cleaned_action = action.strip()
-        # Trim trailing punctuation
-        cleaned_action = re.sub(r"[.؛]+$", "", cleaned_action)
-        actions.append(cleaned_action)
-    return {"question": "تصمیم‌گیری", "branches": actions}
-
-
-def _format_label_with_role(step: str) -> str:
-    return _wrap_label(_label_with_role(step))
+    text = _ws(user_text)
+    # Locate the 'اگر' keywords first, then slice each clause out between
+    # consecutive positions; no backtracking over the full text.
+    positions = [m.start() for m in _RE_AGAR.finditer(text)]
+    if len(positions) < 2:
+        return None
+    positions.append(len(text))
 
+    actions: List[str] = []
+    for start, end in zip(positions, positions[1:]):
+        segment = text[start + 3:end].strip()
+        # Drop a trailing 'و' that merely links to the next clause
+        if segment.endswith(" و"):
+            segment = segment[:-2]
+        # Separate condition from action at the first delimiter, falling
+        # back to the verb that closes the condition ('بود|باشد|است')
+        sep = _RE_CLAUSE_SEP.search(segment)
+        if sep:
+            action = segment[sep.end():]
+        else:
+            verb = _RE_CLAUSE_VERB.search(segment)
+            action = segment[verb.end():] if verb else segment
+        action = _RE_TRAILING_PUNCT.sub("", action.strip(" ،,"))
+        if action:
+            actions.append(action)
 
-def _format_label_with_role_direct(action: str) -> str:
-    return _wrap_label(_label_with_role(action))
+    if len(actions) < 2:
+        return None
+    return {"question": "تصمیم‌گیری", "branches": actions, "_pre_end": agar_at}
 
 
-def _label_with_role(text: str) -> str:
+@lru_cache(maxsize=1024)
+def _label_for_task(step: str) -> Tuple[str, int]:
     """
-    Extract role keywords and place them on the first line, then a divider, then action.
+    Shape a step into a task label in one pass: pull out the role keyword,
+    drop generic prefaces, and word-wrap to fit the task box.
+    Returns the label and its line count (known from the wrap, so the
+    callers need not re-count newlines).
     """
-    roles = [
-        "کارشناس ارشد پشتیبانی ستاد",
-        "کارشناس ارشد",
-        "کارشناس بررسی شکایت",
-        "کارشناس پشتیبانی",
-        "کارشناس شکایت ستاد",
-        "کارشناس ستاد",
-        "کارشناس اولیه",
-        "کارشناس",
-        "کارمند",
-        "کاربر",
-    ]
     role_found = ""
-    for role in roles:
-        if role in text:
-            role_found = role
-            text = text.replace(role, "")
-            break
+    role_match = _find_role(step)
+    if role_match:
+        role_found, role_start, role_end = role_match
+        step = step[:role_start] + step[role_end:]
     # Remove generic prefaces like 'فرایند ... به شرح زیر میباشد'
-    text = re.sub(
-        r"فرایند.+?(?:به شرح (?:ذیل|زیر) (?:میباشد|است)?:?)", "", text)
-    action = text.strip(" :،,-")
-    if role_found:
-        return f"{role_found}\n—\n{action}"
-    return action
+    step = _RE_PREFACE.sub("", step)
+    # Cutting the role or preface out can leave doubled spaces behind.
+    action = _ws(step.strip(" :،,-"))
 
+    if role_found:
+        # Role first, then a divider, then the action.
+        text = f"{role_found} — {action}" if action else f"{role_found} —"
+    else:
+        text = action
+    if not text:
+        return action, 1
 
-def _wrap_label(text: str, max_chars: int = 24) -> str:
-    """
-    Insert line breaks to fit labels into tasks. Wraps by words.
-    """
-    words = text.split()
-    if not words:
-        return text
-
+    # Greedy wrap over `text`, which is already single-spaced: track word
+    # boundaries with str.find and slice whole lines out of the input, so no
+    # per-word lists are built and no per-line join runs.
     lines: List[str] = []
-    current: List[str] = []
-    current_len = 0
-
-    for word in words:
-        sep = 1 if current else 0
-        if current_len + sep + len(word) > max_chars:
-            lines.append(" ".join(current))
-            current = [word]
-            current_len = len(word)
-        else:
-            if sep:
-                current_len += 1
-            current.append(word)
-            current_len += len(word)
+    n = len(text)
+    line_start = 0
+    word_start = 0
+    while word_start < n:
+        space_at = text.find(" ", word_start)
+        word_end = n if space_at == -1 else space_at
+        if word_start != line_start and word_end - line_start > _LABEL_WIDTH:
+            lines.append(text[line_start:word_start - 1])
+            line_start = word_start
+        word_start = word_end + 1
+    lines.append(text[line_start:])
 
-    if current:
-        lines.append(" ".join(current))
+    return "\n".join(lines), len(lines)
 
-    return "\n".join(lines)
 
 
 def _build_diagrams(
@@ -552,8 +670,10 @@ def _build_diagrams(
     """
     Construct BPMN DI definitions (shapes and edges) for a simple linear diagram.
     """
-    shapes = []
-    edges = []
+    shapes = StringIO()
+    edges = StringIO()
+    ws_shape = shapes.write
+    ws_edge = edges.write
 
     start_x = 100
     y = 150
@@ -578,11 +698,9 @@ def _build_diagrams(
 
         bounds[node_id] = (x, y, width, height)
 
-        shapes.append(
-            f"""<bpmndi:BPMNShape id="{node_id}_di" bpmnElement="{node_id}">
-        <dc:Bounds x="{x:.0f}" y="{y:.0f}" width="{width}" height="{height}"/>
-      </bpmndi:BPMNShape>"""
-        )
+        if index:
+            ws_shape("\n      ")
+        ws_shape(_SHAPE_FMT % (node_id, node_id, x, y, width, height))
 
     for index, flow_id in enumerate(flow_ids):
         source_node = nodes[index]
@@ -596,16 +714,12 @@ def _build_diagrams(
         target_x = tx
         target_y = ty + th / 2
 
-        edges.append(
-            f"""<bpmndi:BPMNEdge id="{flow_id}_di" bpmnElement="{flow_id}">
-        <di:waypoint x="{source_x:.0f}" y="{source_y:.0f}"/>
-        <di:waypoint x="{target_x:.0f}" y="{target_y:.0f}"/>
-      </bpmndi:BPMNEdge>"""
-        )
+        if index:
+            ws_edge("\n      ")
+        ws_edge(
+            _EDGE_FMT % (flow_id, flow_id, source_x, source_y, target_x, target_y))
 
-    shapes_xml = "\n      ".join(shapes)
-    edges_xml = "\n      ".join(edges)
-    return shapes_xml, edges_xml
+    return shapes.getvalue(), edges.getvalue()
 
 
 def _build_diagrams_complex(
@@ -616,17 +730,25 @@ def _build_diagrams_complex(
     node_rows: Dict[str, int],
     node_types: Dict[str, str],
 ) -> Tuple[str, str]:
-    shapes: List[str] = []
-    edges_xml: List[str] = []
+    shapes = StringIO()
+    edges_io = StringIO()
+    ws_shape = shapes.write
+    ws_edge = edges_io.write
 
     start_x = 100
     base_y = 150
     row_spacing = 160
     spacing_x = 220
 
-    bounds: Dict[str, Tuple[float, float, float, float]] = {}
+    # Bounds kept as parallel arrays indexed by node ordinal; edges resolve
+    # node ids to small ints once instead of unpacking a 4-tuple per lookup.
+    id_to_idx: Dict[str, int] = {}
+    xs: List[float] = []
+    ys: List[float] = []
+    ws: List[int] = []
+    hs: List[int] = []
 
-    for node_id in nodes_order:
+    for node_index, node_id in enumerate(nodes_order):
         col = node_columns.get(node_id, 0)
         row = node_rows.get(node_id, 0)
         x = start_x + spacing_x * col
@@ -645,25 +767,25 @@ def _build_diagrams_complex(
             height = base_height + extra * 18
             x -= width / 2 - 18
 
-        bounds[node_id] = (x, y, width, height)
-        shapes.append(
-            f"""<bpmndi:BPMNShape id="{node_id}_di" bpmnElement="{node_id}">
-        <dc:Bounds x="{x:.0f}" y="{y:.0f}" width="{width}" height="{height}"/>
-      </bpmndi:BPMNShape>"""
-        )
-
-    for fid, src, dst in edges:
-        sx, sy, sw, sh = bounds[src]
-        tx, ty, tw, th = bounds[dst]
-        source_x = sx + sw
-        source_y = sy + sh / 2
-        target_x = tx
-        target_y = ty + th / 2
-        edges_xml.append(
-            f"""<bpmndi:BPMNEdge id="{fid}_di" bpmnElement="{fid}">
-        <di:waypoint x="{source_x:.0f}" y="{source_y:.0f}"/>
-        <di:waypoint x="{target_x:.0f}" y="{target_y:.0f}"/>
-      </bpmndi:BPMNEdge>"""
-        )
-
-    return "\n      ".join(shapes), "\n      ".join(edges_xml)
+        id_to_idx[node_id] = len(xs)
+        xs.append(x)
+        ys.append(y)
+        ws.append(width)
+        hs.append(height)
+        if node_index:
+            ws_shape("\n      ")
+        ws_shape(_SHAPE_FMT % (node_id, node_id, x, y, width, height))
+
+    for edge_index, (fid, src, dst) in enumerate(edges):
+        si = id_to_idx[src]
+        di = id_to_idx[dst]
+        source_x = xs[si] + ws[si]
+        source_y = ys[si] + hs[si] / 2
+        target_x = xs[di]
+        target_y = ys[di] + hs[di] / 2
+        if edge_index:
+            ws_edge("\n      ")
+        ws_edge(
+            _EDGE_FMT % (fid, fid, source_x, source_y, target_x, target_y))
+
+    return shapes.getvalue(), edges_io.getvalue()
@@ -1,10 +1,27 @@
 import os
-from flask import Blueprint, jsonify, render_template, request, send_from_directory
+from flask import (
+    Blueprint,
+    current_app,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+)
+
+try:
+    # Optional speedup: C-level JSON encoding for the multi-KB diagram payload.
+    import orjson
+except ImportError:
+    orjson = None
 
 from .converter import convert_text_to_bpmn
 
 bp = Blueprint("main", __name__)
 
+# Resolved once at import; the assets directory never moves at runtime.
+_ASSETS_DIR = os.path.join(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), "..")), "assets")
+
 
 @bp.route("/", methods=["GET"])
 def index():
@@ -29,17 +46,20 @@ def convert():
     try:
         diagram = convert_text_to_bpmn(user_text)
     except ValueError as exc:
+        # Error payloads are tiny; jsonify is fine here.
         return jsonify({"error": str(exc)}), 400
 
+    if orjson is not None:
+        return current_app.response_class(
+            orjson.dumps({"bpmn": diagram}), mimetype="application/json")
     return jsonify({"bpmn": diagram})
 
 
 # Serve guided tour assets placed under project 'assets' directory
 @bp.route("/assets/<path:filename>")
 def serve_assets(filename: str):
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    assets_dir = os.path.join(base_dir, "assets")
-    return send_from_directory(assets_dir, filename)
+    # Tour assets are immutable, so let clients cache them for a year.
+    return send_from_directory(_ASSETS_DIR, filename, max_age=31536000)
 
 
 